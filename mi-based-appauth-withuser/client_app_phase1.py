@@ -5,34 +5,101 @@ Demonstrates calling API using app registration tokens via workload identity
 
 import asyncio
 import aiohttp
-import json
+import aiohttp.resolver
+import logging
 import os
+import sys
+import time
+from typing import Optional
 from azure.identity.aio import DefaultAzureCredential
 from azure.core.exceptions import ClientAuthenticationError
 
+logger = logging.getLogger(__name__)
+
+# Refresh tokens this many seconds before they expire
+TOKEN_REFRESH_SKEW = 300
+
+# HTTP methods the API exposes
+_ALLOWED_METHODS = frozenset({'GET', 'POST', 'PUT'})
+
+def _make_resolver():
+    """
+    Use the aiodns-backed resolver where available, otherwise the default threaded one
+    """
+    # aiodns needs a selector event loop, which is not the default on Windows
+    if sys.platform != 'win32':
+        try:
+            return aiohttp.resolver.AsyncResolver()
+        except RuntimeError:
+            # aiodns is not installed
+            pass
+    return aiohttp.resolver.ThreadedResolver()
+
 class APIClient:
     def __init__(self):
         self.api_base_url = os.environ.get('API_BASE_URL', 'http://api-service:8000')
         self.api_scope = os.environ.get('API_SCOPE')  # e.g., "api://your-api-app-id/.default"
         self.credential = DefaultAzureCredential()
         self.token_cache = {}
+        self._token_lock = asyncio.Lock()
+        self._session: Optional[aiohttp.ClientSession] = None
+        
+    async def _get_session(self):
+        """
+        Get the shared HTTP session, creating it on first use
+        """
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(
+                resolver=_make_resolver(),
+                use_dns_cache=True,
+                ttl_dns_cache=300,
+                limit=100,
+                limit_per_host=32,
+                enable_cleanup_closed=True
+            )
+            self._session = aiohttp.ClientSession(connector=connector)
+        return self._session
+    
+    async def aclose(self):
+        """
+        Close the shared HTTP session
+        """
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
         
+    def _get_cached_token(self):
+        """
+        Return the cached token unless it is missing or about to expire
+        """
+        cached = self.token_cache.get('access_token')
+        if cached and cached[1] - time.time() > TOKEN_REFRESH_SKEW:
+            return cached[0]
+        return None
+    
     async def get_access_token(self):
         """
         Get access token for API using workload identity
         """
         try:
             # Check cache first (tokens are valid for 24 hours)
-            if 'access_token' in self.token_cache:
-                return self.token_cache['access_token']
-            
-            # Get token using managed identity via workload identity
-            token = await self.credential.get_token(self.api_scope)
+            cached = self._get_cached_token()
+            if cached:
+                return cached
             
-            # Cache the token
-            self.token_cache['access_token'] = token.token
-            
-            return token.token
+            async with self._token_lock:
+                # Another coroutine may have refreshed the token while we waited
+                cached = self._get_cached_token()
+                if cached:
+                    return cached
+                
+                # Get token using managed identity via workload identity
+                token = await self.credential.get_token(self.api_scope)
+                
+                # Cache the token along with its expiry
+                self.token_cache['access_token'] = (token.token, token.expires_on)
+                
+                return token.token
             
         except ClientAuthenticationError as e:
             print(f"Authentication failed: {e}")
@@ -41,37 +108,85 @@ class APIClient:
             print(f"Token acquisition failed: {e}")
             raise
     
+    def _invalidate_token(self, token):
+        """
+        Drop the cached token if it is the one the API rejected
+        """
+        # Concurrent requests rejected with the same token trigger a single refresh
+        cached = self.token_cache.get('access_token')
+        if cached and cached[0] == token:
+            self.token_cache.clear()
+    
     async def make_authenticated_request(self, method, endpoint, data=None):
         """
         Make authenticated API request
         """
         try:
-            token = await self.get_access_token()
+            url = f"{self.api_base_url}{endpoint}"
             
-            headers = {
-                'Authorization': f'Bearer {token}',
-                'Content-Type': 'application/json'
-            }
+            method = method.upper()
+            if method not in _ALLOWED_METHODS:
+                raise ValueError(f"Unsupported HTTP method: {method}")
             
-            url = f"{self.api_base_url}{endpoint}"
+            session = await self._get_session()
             
-            async with aiohttp.ClientSession() as session:
-                if method.upper() == 'GET':
-                    async with session.get(url, headers=headers) as response:
-                        return await self.handle_response(response)
-                elif method.upper() == 'POST':
-                    async with session.post(url, headers=headers, json=data) as response:
-                        return await self.handle_response(response)
-                elif method.upper() == 'PUT':
-                    async with session.put(url, headers=headers, json=data) as response:
-                        return await self.handle_response(response)
-                else:
-                    raise ValueError(f"Unsupported HTTP method: {method}")
+            for attempt in range(2):
+                token = await self.get_access_token()
+                
+                headers = {
+                    'Authorization': f'Bearer {token}',
+                    'Content-Type': 'application/json'
+                }
+                
+                async with session.request(method, url, headers=headers, json=data) as response:
+                    if response.status == 401 and attempt == 0:
+                        # Token was rejected before its expiry - refresh and retry once
+                        self._invalidate_token(token)
+                        continue
+                    return await self.handle_response(response)
                     
         except Exception as e:
             print(f"API request failed: {e}")
             raise
     
+    async def make_many(self, calls):
+        """
+        Make several authenticated API requests concurrently
+        calls is a list of (method, endpoint, data) tuples; the token and headers
+        are prepared once for the whole batch. A call rejected with 401 is retried
+        once with a refreshed token. Returns a result or exception per call
+        """
+        token = await self.get_access_token()
+        
+        headers = {
+            'Authorization': f'Bearer {token}',
+            'Content-Type': 'application/json'
+        }
+        
+        session = await self._get_session()
+        
+        async def send(method, endpoint, data):
+            method = method.upper()
+            if method not in _ALLOWED_METHODS:
+                raise ValueError(f"Unsupported HTTP method: {method}")
+            
+            url = f"{self.api_base_url}{endpoint}"
+            async with session.request(method, url, headers=headers, json=data) as response:
+                if response.status != 401:
+                    return await self.handle_response(response)
+            
+            # Token was rejected before its expiry - refresh and retry once
+            self._invalidate_token(token)
+            fresh_token = await self.get_access_token()
+            retry_headers = {**headers, 'Authorization': f'Bearer {fresh_token}'}
+            async with session.request(method, url, headers=retry_headers, json=data) as response:
+                return await self.handle_response(response)
+        
+        return await asyncio.gather(
+            *(send(method, endpoint, data) for method, endpoint, data in calls),
+            return_exceptions=True
+        )
+    
     async def handle_response(self, response):
         """
         Handle API response
@@ -79,7 +194,7 @@ class APIClient:
         if response.status == 200 or response.status == 201:
             return await response.json()
         elif response.status == 401:
-            # Clear token cache and retry once
+            # Already retried with a fresh token
             self.token_cache.clear()
             raise Exception("Authentication failed - token may be expired")
         elif response.status == 403:
@@ -90,104 +205,141 @@ class APIClient:
             raise Exception(f"API request failed with status {response.status}: {error_detail}")
 
 class PlanManager:
-    def __init__(self):
-        self.client = APIClient()
+    def __init__(self, client):
+        self.client = client
+    
+    def list_plans_request(self):
+        """Call spec for listing plans, for use with APIClient.make_many"""
+        return ('GET', '/api/plans', None)
+    
+    def log_list_plans(self, result):
+        logger.info("Listed %d plans", len(result.get('plans', [])))
+        logger.debug("Plans result: %s", result)
     
     async def list_plans(self):
         """List all plans (requires planadmin or accountviewer role)"""
         try:
-            result = await self.client.make_authenticated_request('GET', '/api/plans')
-            print("Plans retrieved successfully:")
-            print(json.dumps(result, indent=2))
+            result = await self.client.make_authenticated_request(*self.list_plans_request())
+            self.log_list_plans(result)
             return result
         except Exception as e:
-            print(f"Failed to list plans: {e}")
+            logger.error("Failed to list plans: %s", e)
             return None
     
+    def create_plan_request(self, plan_name):
+        """Call spec for creating a plan, for use with APIClient.make_many"""
+        return ('POST', '/api/plans', {'name': plan_name})
+    
+    def log_create_plan(self, result):
+        logger.info("Created plan %s", result.get('plan', {}).get('id'))
+        logger.debug("Create plan result: %s", result)
+    
     async def create_plan(self, plan_name):
         """Create a new plan (requires planadmin role)"""
         try:
-            plan_data = {'name': plan_name}
-            result = await self.client.make_authenticated_request('POST', '/api/plans', plan_data)
-            print("Plan created successfully:")
-            print(json.dumps(result, indent=2))
+            result = await self.client.make_authenticated_request(*self.create_plan_request(plan_name))
+            self.log_create_plan(result)
             return result
         except Exception as e:
-            print(f"Failed to create plan: {e}")
+            logger.error("Failed to create plan: %s", e)
             return None
 
 class AccountManager:
-    def __init__(self):
-        self.client = APIClient()
+    def __init__(self, client):
+        self.client = client
+    
+    def list_accounts_request(self):
+        """Call spec for listing accounts, for use with APIClient.make_many"""
+        return ('GET', '/api/accounts', None)
+    
+    def log_list_accounts(self, result):
+        logger.info("Listed %d accounts", len(result.get('accounts', [])))
+        logger.debug("Accounts result: %s", result)
     
     async def list_accounts(self):
         """List all accounts (requires accountviewer or accountadmin role)"""
         try:
-            result = await self.client.make_authenticated_request('GET', '/api/accounts')
-            print("Accounts retrieved successfully:")
-            print(json.dumps(result, indent=2))
+            result = await self.client.make_authenticated_request(*self.list_accounts_request())
+            self.log_list_accounts(result)
             return result
         except Exception as e:
-            print(f"Failed to list accounts: {e}")
+            logger.error("Failed to list accounts: %s", e)
             return None
     
+    def update_account_settings_request(self, account_id, settings):
+        """Call spec for updating account settings, for use with APIClient.make_many"""
+        return ('PUT', f'/api/accounts/{account_id}/settings', settings)
+    
+    def log_update_account_settings(self, result):
+        logger.info("%s", result.get('message', 'Account settings updated'))
+        logger.debug("Update account settings result: %s", result)
+    
     async def update_account_settings(self, account_id, settings):
         """Update account settings (requires accountadmin role)"""
         try:
             result = await self.client.make_authenticated_request(
-                'PUT', 
-                f'/api/accounts/{account_id}/settings', 
-                settings
+                *self.update_account_settings_request(account_id, settings)
             )
-            print("Account settings updated successfully:")
-            print(json.dumps(result, indent=2))
+            self.log_update_account_settings(result)
             return result
         except Exception as e:
-            print(f"Failed to update account settings: {e}")
+            logger.error("Failed to update account settings: %s", e)
             return None
 
-async def demonstrate_api_calls():
+async def demonstrate_api_calls(api_client):
     """
     Demonstrate various API calls with different role requirements
     """
     print("=== Client App Demo - Phase 1 (App Registration) ===")
     
-    plan_manager = PlanManager()
-    account_manager = AccountManager()
-    
-    # Test plan operations
-    print("\n1. Testing Plan Operations:")
-    await plan_manager.list_plans()
-    await plan_manager.create_plan("Demo Plan from Client")
-    
-    # Test account operations  
-    print("\n2. Testing Account Operations:")
-    await account_manager.list_accounts()
-    await account_manager.update_account_settings(1, {
-        'notification_enabled': True,
-        'theme': 'dark'
-    })
+    # Both managers share one client, so one credential and one connection pool
+    plan_manager = PlanManager(api_client)
+    account_manager = AccountManager(api_client)
+    
+    # The plan and account operations are independent, so send them as one
+    # concurrent batch that shares a single token lookup and connection pool
+    print("\nTesting Plan and Account Operations:")
+    operations = [
+        ('List plans', plan_manager.list_plans_request(), plan_manager.log_list_plans),
+        ('Create plan', plan_manager.create_plan_request("Demo Plan from Client"),
+         plan_manager.log_create_plan),
+        ('List accounts', account_manager.list_accounts_request(), account_manager.log_list_accounts),
+        ('Update account settings', account_manager.update_account_settings_request(1, {
+            'notification_enabled': True,
+            'theme': 'dark'
+        }), account_manager.log_update_account_settings)
+    ]
+    results = await api_client.make_many([call for _, call, _ in operations])
+    
+    print("\nSummary:")
+    for (operation, _, log_result), result in zip(operations, results):
+        if isinstance(result, Exception):
+            logger.error("%s failed: %s", operation, result)
+            print(f"  {operation}: failed")
+        else:
+            log_result(result)
+            print(f"  {operation}: succeeded")
 
-async def test_health_endpoint():
+async def test_health_endpoint(client):
     """Test the health endpoint (no authentication required)"""
     try:
-        client = APIClient()
         # Override to make unauthenticated request
         url = f"{client.api_base_url}/health"
         
-        async with aiohttp.ClientSession() as session:
-            async with session.get(url) as response:
-                if response.status == 200:
-                    result = await response.json()
-                    print("Health check passed:")
-                    print(json.dumps(result, indent=2))
-                else:
-                    print(f"Health check failed: {response.status}")
+        session = await client._get_session()
+        async with session.get(url) as response:
+            if response.status == 200:
+                result = await response.json()
+                logger.info("Health check passed: %s", result.get('status'))
+                logger.debug("Health check result: %s", result)
+            else:
+                logger.warning("Health check failed: %s", response.status)
     except Exception as e:
-        print(f"Health check error: {e}")
+        logger.error("Health check error: %s", e)
 
 async def main():
     """Main execution function"""
+    logging.basicConfig(level=os.environ.get('LOG_LEVEL', 'INFO'))
     
     # Check environment variables
     required_env_vars = ['API_SCOPE', 'AZURE_TENANT_ID', 'AZURE_CLIENT_ID']
@@ -200,20 +352,23 @@ async def main():
             print(f"  export {var}=<value>")
         return
     
+    api_client = APIClient()
     try:
         # Test health endpoint first
         print("Testing health endpoint...")
-        await test_health_endpoint()
+        await test_health_endpoint(api_client)
         
         print("\n" + "="*50)
         
         # Run the demonstration
-        await demonstrate_api_calls()
+        await demonstrate_api_calls(api_client)
         
     except KeyboardInterrupt:
         print("\nDemo interrupted by user")
     except Exception as e:
         print(f"Demo failed: {e}")
+    finally:
+        await api_client.aclose()
 
 if __name__ == "__main__":
     asyncio.run(main())
\ No newline at end of file
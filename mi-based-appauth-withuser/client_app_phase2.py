@@ -5,74 +5,199 @@ Demonstrates calling API using managed identity tokens directly
 
 import asyncio
 import aiohttp
-import json
+import orjson
+import logging
+import logging.handlers
 import os
-from azure.identity.aio import DefaultAzureCredential
+import queue
+import time
+from typing import Optional
+from azure.core.credentials import AccessToken
+from azure.identity.aio import ManagedIdentityCredential
 from azure.core.exceptions import ClientAuthenticationError
 
+logger = logging.getLogger(__name__)
+
+# Configuration
+API_BASE_URL = os.environ.get('API_BASE_URL', 'http://api-service:8000')
+CLIENT_ID = os.environ.get('AZURE_CLIENT_ID')  # Managed Identity client ID
+API_POOL_LIMIT = int(os.environ.get('API_POOL_LIMIT', '200'))
+API_POOL_PER_HOST = int(os.environ.get('API_POOL_PER_HOST', '50'))
+REQUIRED_ENV = ('AZURE_TENANT_ID', 'AZURE_CLIENT_ID')
+
+# Refresh tokens this many seconds before they expire
+TOKEN_REFRESH_SKEW = 300
+
+# Retries for connection-level failures; HTTP error statuses are not retried
+MAX_REQUEST_ATTEMPTS = 3
+RETRY_BACKOFF = 0.1
+# No connection was made, so the server never saw the request
+_CONNECT_ERRORS = (aiohttp.ClientConnectorError,)
+# The server may already have run the request, so only idempotent methods are retried
+_TRANSIENT_ERRORS = (
+    aiohttp.ClientConnectorError,
+    aiohttp.ServerDisconnectedError,
+    asyncio.TimeoutError
+)
+_IDEMPOTENT_METHODS = frozenset({'GET', 'PUT', 'DELETE'})
+
+# HTTP methods the client will send
+_ALLOWED_METHODS = frozenset({'GET', 'POST', 'PUT', 'DELETE', 'PATCH'})
+
 class ManagedIdentityAPIClient:
-    def __init__(self):
-        self.api_base_url = os.environ.get('API_BASE_URL', 'http://api-service:8000')
+    # Headers sent with every request; only the Authorization header varies
+    _BASE_HEADERS = {
+        'Content-Type': 'application/json',
+        'User-Agent': 'ManagedIdentityClient/1.0'
+    }
+    
+    def __init__(self, pool_limit=None, pool_limit_per_host=None):
+        self.api_base_url = API_BASE_URL
+        # Connection pool sizing; size these to the expected concurrency against the API
+        self.pool_limit = API_POOL_LIMIT if pool_limit is None else pool_limit
+        self.pool_limit_per_host = API_POOL_PER_HOST if pool_limit_per_host is None else pool_limit_per_host
         # For managed identity, we typically request tokens for Azure management scope
         self.token_scope = "https://management.azure.com/.default"
-        self.credential = DefaultAzureCredential()
-        self.token_cache = {}
+        # Only managed identity is expected here, so skip DefaultAzureCredential's chain of probes
+        self.credential = ManagedIdentityCredential(client_id=CLIENT_ID)
+        self._token: Optional[AccessToken] = None
+        self._token_lock = asyncio.Lock()
+        self._auth_header: Optional[str] = None
+        self._session: Optional[aiohttp.ClientSession] = None
         
+    async def __aenter__(self):
+        return self
+    
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.aclose()
+    
+    async def _get_session(self):
+        """
+        Get the shared HTTP session, creating it on first use
+        """
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=self.pool_limit,
+                limit_per_host=self.pool_limit_per_host,
+                ttl_dns_cache=300,
+                use_dns_cache=True,
+                keepalive_timeout=75,
+                enable_cleanup_closed=True
+            )
+            self._session = aiohttp.ClientSession(
+                timeout=aiohttp.ClientTimeout(total=30),
+                connector=connector
+            )
+        return self._session
+    
+    async def aclose(self):
+        """
+        Close the shared HTTP session and the credential
+        """
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+        await self.credential.close()
+        
+    def _get_cached_token(self):
+        """
+        Return the cached token unless it is missing or about to expire
+        """
+        if self._token is not None and self._token.expires_on - time.time() > TOKEN_REFRESH_SKEW:
+            return self._token.token
+        return None
+    
     async def get_managed_identity_token(self):
         """
         Get managed identity token for authentication
         """
         try:
-            # Check cache first (tokens are valid for 24 hours)
-            if 'access_token' in self.token_cache:
-                return self.token_cache['access_token']
+            # Check cache first (tokens are valid for 24 hours, but may expire early)
+            cached = self._get_cached_token()
+            if cached:
+                return cached
             
-            # Get token using managed identity
-            token = await self.credential.get_token(self.token_scope)
-            
-            # Cache the token
-            self.token_cache['access_token'] = token.token
-            
-            print(f"Acquired new managed identity token (expires: {token.expires_on})")
-            return token.token
+            async with self._token_lock:
+                # Another coroutine may have refreshed the token while we waited
+                cached = self._get_cached_token()
+                if cached:
+                    return cached
+                
+                # Get token using managed identity
+                self._token = await self.credential.get_token(self.token_scope)
+                self._auth_header = f"Bearer {self._token.token}"
+                
+                logger.info("Acquired new managed identity token (expires: %s)", self._token.expires_on)
+                return self._token.token
             
         except ClientAuthenticationError as e:
-            print(f"Managed identity authentication failed: {e}")
+            logger.error("Managed identity authentication failed: %s", e)
             raise
         except Exception as e:
-            print(f"Token acquisition failed: {e}")
+            logger.error("Token acquisition failed: %s", e)
             raise
     
+    def _invalidate_token(self, token):
+        """
+        Drop the cached token if it is the one the API rejected
+        """
+        # Concurrent requests rejected with the same token trigger a single refresh
+        if self._token is not None and self._token.token == token:
+            self._token = None
+            self._auth_header = None
+    
     async def make_authenticated_request(self, method, endpoint, data=None):
         """
         Make authenticated API request using managed identity
+        data may be a JSON-serializable object or bytes that are already JSON-encoded
         """
         try:
-            token = await self.get_managed_identity_token()
+            url = f"{self.api_base_url}{endpoint}"
             
-            headers = {
-                'Authorization': f'Bearer {token}',
-                'Content-Type': 'application/json',
-                'User-Agent': 'ManagedIdentityClient/1.0'
-            }
+            method = method.upper()
+            if method not in _ALLOWED_METHODS:
+                raise ValueError(f"Unsupported HTTP method: {method}")
             
-            url = f"{self.api_base_url}{endpoint}"
+            # Encode with orjson (Content-Type is already in the base headers);
+            # pre-encoded bytes are sent as they are
+            body = data if data is None or isinstance(data, bytes) else orjson.dumps(data)
+            
+            session = await self._get_session()
+            retryable = _TRANSIENT_ERRORS if method in _IDEMPOTENT_METHODS else _CONNECT_ERRORS
             
-            async with aiohttp.ClientSession() as session:
-                if method.upper() == 'GET':
-                    async with session.get(url, headers=headers) as response:
-                        return await self.handle_response(response)
-                elif method.upper() == 'POST':
-                    async with session.post(url, headers=headers, json=data) as response:
-                        return await self.handle_response(response)
-                elif method.upper() == 'PUT':
-                    async with session.put(url, headers=headers, json=data) as response:
-                        return await self.handle_response(response)
-                else:
-                    raise ValueError(f"Unsupported HTTP method: {method}")
+            attempt = 0
+            token_refreshed = False
+            while True:
+                # Ensures a fresh token; the Bearer header is rebuilt only when the token changes
+                token = await self.get_managed_identity_token()
+                
+                headers = {**self._BASE_HEADERS, 'Authorization': self._auth_header}
+                
+                # A dropped connection or timeout can come after the server has run the
+                # request, so those are retried only for idempotent methods; POST and
+                # PATCH are retried only if the connection could not be made at all. Failures
+                # reading the body are never retried
+                try:
+                    response = await session.request(method, url, headers=headers, data=body)
+                except retryable as e:
+                    attempt += 1
+                    if attempt >= MAX_REQUEST_ATTEMPTS:
+                        raise
+                    logger.warning("Transient error calling %s (attempt %d): %s", url, attempt, e)
+                    await asyncio.sleep(RETRY_BACKOFF * 2 ** (attempt - 1))
+                    continue
+                
+                async with response:
+                    if response.status == 401:
+                        self._invalidate_token(token)
+                        if not token_refreshed:
+                            # Token was rejected before its expiry - refresh it and retry once
+                            token_refreshed = True
+                            continue
+                    return await self.handle_response(response)
                     
         except Exception as e:
-            print(f"API request failed: {e}")
+            logger.error("API request failed: %s", e)
             raise
     
     async def handle_response(self, response):
@@ -80,38 +205,40 @@ class ManagedIdentityAPIClient:
         Handle API response with improved error handling
         """
         try:
-            response_text = await response.text()
+            # Parse the raw bytes directly rather than decoding to str first
+            body = await response.read()
             
-            if response.status == 200 or response.status == 201:
-                return json.loads(response_text) if response_text else {}
-            elif response.status == 401:
-                # Clear token cache and provide clear error
-                self.token_cache.clear()
-                error_detail = json.loads(response_text) if response_text else {}
-                raise Exception(f"Authentication failed: {error_detail.get('error', 'Invalid or expired token')}")
-            elif response.status == 403:
-                error_detail = json.loads(response_text) if response_text else {}
-                raise Exception(f"Authorization failed: {error_detail.get('error', 'Insufficient permissions')}")
-            else:
-                error_detail = json.loads(response_text) if response_text else {}
-                raise Exception(f"API request failed with status {response.status}: {error_detail}")
+            # Success is the common case: a single parse, no error handling
+            if response.status in (200, 201):
+                return orjson.loads(body) if body else {}
+            
+            error_detail = orjson.loads(body) if body else {}
+            if not isinstance(error_detail, dict):
+                error_detail = {'error': error_detail}
                 
-        except json.JSONDecodeError:
-            raise Exception(f"API request failed with status {response.status}: {response_text}")
+        except orjson.JSONDecodeError:
+            raise Exception(f"API request failed with status {response.status}: {body.decode(errors='replace')}")
+        
+        if response.status == 401:
+            raise Exception(f"Authentication failed: {error_detail.get('error', 'Invalid or expired token')}")
+        elif response.status == 403:
+            raise Exception(f"Authorization failed: {error_detail.get('error', 'Insufficient permissions')}")
+        else:
+            raise Exception(f"API request failed with status {response.status}: {error_detail}")
 
 class PlanManagerV2:
-    def __init__(self):
-        self.client = ManagedIdentityAPIClient()
+    def __init__(self, client):
+        self.client = client
     
     async def list_plans(self):
         """List all plans (permission: read on plans)"""
         try:
             result = await self.client.make_authenticated_request('GET', '/api/plans')
-            print("Plans retrieved successfully:")
-            print(json.dumps(result, indent=2))
+            logger.info("Listed %d plans", len(result.get('plans', [])))
+            logger.debug("Plans result: %s", result)
             return result
         except Exception as e:
-            print(f"Failed to list plans: {e}")
+            logger.error("Failed to list plans: %s", e)
             return None
     
     async def create_plan(self, plan_name):
@@ -119,26 +246,26 @@ class PlanManagerV2:
         try:
             plan_data = {'name': plan_name}
             result = await self.client.make_authenticated_request('POST', '/api/plans', plan_data)
-            print("Plan created successfully:")
-            print(json.dumps(result, indent=2))
+            logger.info("Created plan %s", result.get('plan', {}).get('id'))
+            logger.debug("Create plan result: %s", result)
             return result
         except Exception as e:
-            print(f"Failed to create plan: {e}")
+            logger.error("Failed to create plan: %s", e)
             return None
 
 class AccountManagerV2:
-    def __init__(self):
-        self.client = ManagedIdentityAPIClient()
+    def __init__(self, client):
+        self.client = client
     
     async def list_accounts(self):
         """List all accounts (permission: read on accounts)"""
         try:
             result = await self.client.make_authenticated_request('GET', '/api/accounts')
-            print("Accounts retrieved successfully:")
-            print(json.dumps(result, indent=2))
+            logger.info("Listed %d accounts", len(result.get('accounts', [])))
+            logger.debug("Accounts result: %s", result)
             return result
         except Exception as e:
-            print(f"Failed to list accounts: {e}")
+            logger.error("Failed to list accounts: %s", e)
             return None
     
     async def update_account_settings(self, account_id, settings):
@@ -149,107 +276,151 @@ class AccountManagerV2:
                 f'/api/accounts/{account_id}/settings', 
                 settings
             )
-            print("Account settings updated successfully:")
-            print(json.dumps(result, indent=2))
+            logger.info("Updated settings for account %s", account_id)
+            logger.debug("Update account settings result: %s", result)
             return result
         except Exception as e:
-            print(f"Failed to update account settings: {e}")
+            logger.error("Failed to update account settings: %s", e)
             return None
     
     async def get_permissions(self):
         """Get current user's permissions"""
         try:
             result = await self.client.make_authenticated_request('GET', '/api/user/permissions')
-            print("User permissions retrieved:")
-            print(json.dumps(result, indent=2))
+            logger.info("Retrieved permissions for %s", result.get('user_id'))
+            logger.debug("Permissions result: %s", result)
             return result
         except Exception as e:
-            print(f"Failed to get permissions: {e}")
+            logger.error("Failed to get permissions: %s", e)
             return None
 
-async def demonstrate_managed_identity_auth():
+# Settings sent by the demo, encoded once since they never change
+DEMO_ACCOUNT_SETTINGS = orjson.dumps({
+    'notification_enabled': True,
+    'theme': 'dark',
+    'auto_backup': True
+})
+
+async def demonstrate_managed_identity_auth(client):
     """
     Demonstrate API calls using pure managed identity authentication
     """
-    print("=== Client App Demo - Phase 2 (Managed Identity + PlainID) ===")
-    print("Authentication: Managed Identity")
-    print("Authorization: PlainID Fine-grained Permissions")
-    
-    plan_manager = PlanManagerV2()
-    account_manager = AccountManagerV2()
-    
-    # Get user permissions first
-    print("\n1. Getting User Permissions:")
-    await account_manager.get_permissions()
-    
-    # Test plan operations
-    print("\n2. Testing Plan Operations:")
-    await plan_manager.list_plans()
-    await plan_manager.create_plan("Strategic Plan 2025 - MI Version")
-    
-    # Test account operations  
-    print("\n3. Testing Account Operations:")
-    await account_manager.list_accounts()
-    await account_manager.update_account_settings(1, {
-        'notification_enabled': True,
-        'theme': 'dark',
-        'auto_backup': True
-    })
-
-async def test_health_endpoint():
+    logger.info("=== Client App Demo - Phase 2 (Managed Identity + PlainID) ===")
+    logger.info("Authentication: Managed Identity")
+    logger.info("Authorization: PlainID Fine-grained Permissions")
+    
+    # Both managers share one client, so one token cache and one connection pool
+    plan_manager = PlanManagerV2(client)
+    account_manager = AccountManagerV2(client)
+    
+    # Reads have no dependencies on each other, so run them concurrently
+    logger.info("\n1. Getting Permissions, Plans and Accounts:")
+    await asyncio.gather(
+        account_manager.get_permissions(),
+        plan_manager.list_plans(),
+        account_manager.list_accounts(),
+        return_exceptions=True
+    )
+    
+    # Then run the writes concurrently
+    logger.info("\n2. Creating Plan and Updating Account Settings:")
+    await asyncio.gather(
+        plan_manager.create_plan("Strategic Plan 2025 - MI Version"),
+        account_manager.update_account_settings(1, DEMO_ACCOUNT_SETTINGS),
+        return_exceptions=True
+    )
+
+async def test_health_endpoint(client):
     """Test the health endpoint (no authentication required)"""
     try:
-        client = ManagedIdentityAPIClient()
         url = f"{client.api_base_url}/health"
         
-        async with aiohttp.ClientSession() as session:
-            async with session.get(url) as response:
-                if response.status == 200:
-                    result = await response.json()
-                    print("Health check passed:")
-                    print(json.dumps(result, indent=2))
-                else:
-                    print(f"Health check failed: {response.status}")
+        session = await client._get_session()
+        async with session.get(url) as response:
+            if response.status == 200:
+                result = await response.json(loads=orjson.loads)
+                logger.info("Health check passed: %s", result.get('status'))
+                logger.debug("Health check result: %s", result)
+            else:
+                logger.warning("Health check failed: %s", response.status)
     except Exception as e:
-        print(f"Health check error: {e}")
+        logger.error("Health check error: %s", e)
 
-async def main():
-    """Main execution function for Phase 2 demo"""
+def _start_logging():
+    """
+    Send log records through a queue so a background thread does the blocking writes
+    """
+    log_queue = queue.SimpleQueue()
+    handler = logging.StreamHandler()
+    handler.setFormatter(logging.Formatter('%(message)s'))
+    listener = logging.handlers.QueueListener(log_queue, handler)
     
-    # Check environment variables
-    required_env_vars = ['AZURE_TENANT_ID', 'AZURE_CLIENT_ID']
-    missing_vars = [var for var in required_env_vars if not os.environ.get(var)]
+    root_logger = logging.getLogger()
+    root_logger.setLevel(os.environ.get('LOG_LEVEL', 'INFO'))
+    root_logger.addHandler(logging.handlers.QueueHandler(log_queue))
     
-    if missing_vars:
-        print(f"Missing required environment variables: {missing_vars}")
-        print("Please set the following environment variables:")
-        for var in missing_vars:
-            print(f"  export {var}=<value>")
-        return
+    listener.start()
+    return listener
+
+async def run_demo(client):
+    """
+    Run the Phase 2 demo using an existing client
+    Callers with their own event loop and client can await this directly
+    """
+    # Test health endpoint first
+    logger.info("Testing health endpoint...")
+    await test_health_endpoint(client)
+    
+    logger.info("\n" + "="*60)
+    
+    # Run the demonstration
+    await demonstrate_managed_identity_auth(client)
+    
+    logger.info("\n" + "="*60)
+    logger.info("Demo completed successfully!")
+    logger.info("\nKey differences from Phase 1:")
+    logger.info("✓ No app registration required")
+    logger.info("✓ Direct managed identity authentication")
+    logger.info("✓ Fine-grained authorization via PlainID")
+    logger.info("✓ Reduced security team dependencies")
+    logger.info("✓ Simplified token management")
+
+async def _entry():
+    """Main execution function for Phase 2 demo"""
+    listener = _start_logging()
     
     try:
-        # Test health endpoint first
-        print("Testing health endpoint...")
-        await test_health_endpoint()
-        
-        print("\n" + "="*60)
+        # Check environment variables
+        missing_vars = [var for var in REQUIRED_ENV if not os.environ.get(var)]
         
-        # Run the demonstration
-        await demonstrate_managed_identity_auth()
-        
-        print("\n" + "="*60)
-        print("Demo completed successfully!")
-        print("\nKey differences from Phase 1:")
-        print("✓ No app registration required")
-        print("✓ Direct managed identity authentication") 
-        print("✓ Fine-grained authorization via PlainID")
-        print("✓ Reduced security team dependencies")
-        print("✓ Simplified token management")
+        if missing_vars:
+            logger.error("Missing required environment variables: %s", missing_vars)
+            logger.error("Please set the following environment variables:")
+            for var in missing_vars:
+                logger.error("  export %s=<value>", var)
+            return
         
+        async with ManagedIdentityAPIClient() as client:
+            await run_demo(client)
+            
     except KeyboardInterrupt:
-        print("\nDemo interrupted by user")
+        logger.info("\nDemo interrupted by user")
     except Exception as e:
-        print(f"Demo failed: {e}")
+        logger.error("Demo failed: %s", e)
+    finally:
+        # Flush any queued records before exiting
+        listener.stop()
+
+def main_sync():
+    """Run the Phase 2 demo in its own event loop"""
+    # Prefer the libuv-based event loop where it is available (POSIX only)
+    try:
+        import uvloop
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    except ImportError:
+        pass
+    
+    asyncio.run(_entry())
 
 if __name__ == "__main__":
-    asyncio.run(main())
\ No newline at end of file
+    main_sync()
@@ -4,62 +4,162 @@ Demonstrates role-based authorization using Entra ID app registration roles
 """
 
 from flask import Flask, request, jsonify
-from azure.identity import DefaultAzureCredential
+from flask.json.provider import DefaultJSONProvider
 import jwt
+import orjson
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import os
+import hashlib
+import threading
+import time
 from functools import wraps
+from cachetools import TLRUCache
+
+class ORJSONProvider(DefaultJSONProvider):
+    """
+    Flask JSON provider backed by orjson
+    """
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, default=self.default).decode()
+    
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
 
 app = Flask(__name__)
+app.json = ORJSONProvider(app)
 
 # Configuration
 TENANT_ID = os.environ.get('AZURE_TENANT_ID')
 CLIENT_ID = os.environ.get('AZURE_CLIENT_ID')  # API app registration client ID
 
+# Azure AD signing keys, indexed by kid and stored as parsed RSA public keys
+_JWKS_TTL = 3600
+_JWKS_MIN_REFRESH_INTERVAL = 60
+_JWKS_CACHE = {'fetched_at': 0, 'keys_by_kid': {}}
+_JWKS_LOCK = threading.Lock()
+
+# Validated token payloads are reused until this many seconds before the token expires
+_TOKEN_EXPIRY_SKEW = 30
+
+def _build_http_session():
+    """
+    Build a pooled HTTP session with keep-alive and retries on transient errors
+    """
+    session = requests.Session()
+    retries = Retry(
+        total=2,
+        backoff_factor=0.1,
+        status_forcelist=[502, 503, 504]
+    )
+    session.mount('https://', HTTPAdapter(pool_connections=32, pool_maxsize=64, max_retries=retries))
+    return session
+
 class AuthValidator:
     def __init__(self):
         self.tenant_id = TENANT_ID
         self.client_id = CLIENT_ID
-        self.credential = DefaultAzureCredential()
+        self._http = _build_http_session()
+        self._validated_tokens = TLRUCache(
+            maxsize=10000,
+            ttu=lambda _hash, payload, _now: payload['exp'] - _TOKEN_EXPIRY_SKEW,
+            timer=time.time
+        )
+        self._validated_tokens_lock = threading.RLock()
         
-    def validate_token_and_roles(self, token, required_roles):
+    def _get_cached_payload(self, token_hash):
         """
-        Validate JWT token and check for required roles
+        Get a previously validated token payload, if it has not expired yet
         """
-        try:
+        with self._validated_tokens_lock:
+            return self._validated_tokens.get(token_hash)
+    
+    def _cache_payload(self, token_hash, payload):
+        """
+        Remember a validated token payload until shortly before the token expires
+        """
+        if 'exp' in payload:
+            with self._validated_tokens_lock:
+                self._validated_tokens[token_hash] = payload
+    
+    def _get_cached_jwk(self, kid):
+        """
+        Look up an already-parsed signing key, ignoring the cache once it is stale
+        """
+        if time.time() - _JWKS_CACHE['fetched_at'] < _JWKS_TTL:
+            return _JWKS_CACHE['keys_by_kid'].get(kid)
+        return None
+    
+    def _get_jwk_for_kid(self, kid):
+        """
+        Get the signing key for a kid, refreshing the cached JWKS when stale
+        """
+        key = self._get_cached_jwk(kid)
+        if key is not None:
+            return key
+        
+        with _JWKS_LOCK:
+            # Another thread may have refreshed the keys while we waited
+            key = self._get_cached_jwk(kid)
+            if key is not None:
+                return key
+            
+            # An unknown kid on fresh keys usually means the keys rotated; force a single
+            # refresh, but not more than once per interval so bogus kids cannot flood Azure AD
+            if time.time() - _JWKS_CACHE['fetched_at'] < _JWKS_MIN_REFRESH_INTERVAL:
+                return None
+            
             # Get Azure AD public keys for token validation
             jwks_url = f"https://login.microsoftonline.com/{self.tenant_id}/discovery/v2.0/keys"
-            jwks_response = requests.get(jwks_url)
+            jwks_response = self._http.get(jwks_url, timeout=5)
+            jwks_response.raise_for_status()
             jwks = jwks_response.json()
             
-            # Decode and validate token (simplified - use proper JWT validation in production)
-            header = jwt.get_unverified_header(token)
-            
-            # Find the correct key
-            key = None
-            for jwk in jwks['keys']:
-                if jwk['kid'] == header['kid']:
-                    key = jwt.algorithms.RSAAlgorithm.from_jwk(jwk)
-                    break
-            
-            if not key:
-                return False, "Invalid token - key not found"
-            
-            # Decode token
-            payload = jwt.decode(
-                token,
-                key,
-                algorithms=['RS256'],
-                audience=f"api://{self.client_id}",
-                issuer=f"https://sts.windows.net/{self.tenant_id}/"
-            )
+            _JWKS_CACHE['keys_by_kid'] = {
+                jwk['kid']: jwt.algorithms.RSAAlgorithm.from_jwk(jwk)
+                for jwk in jwks['keys']
+            }
+            _JWKS_CACHE['fetched_at'] = time.time()
+            return _JWKS_CACHE['keys_by_kid'].get(kid)
+        
+    def validate_token_and_roles(self, token, required_roles):
+        """
+        Validate JWT token and check for required roles
+        required_roles is a frozenset; the token must hold at least one of them
+        """
+        try:
+            # Reuse the result of an earlier validation of the same token
+            token_hash = hashlib.blake2b(token.encode(), digest_size=16).digest()
+            payload = self._get_cached_payload(token_hash)
             
+            if payload is None:
+                # Decode and validate token (simplified - use proper JWT validation in production)
+                header = jwt.get_unverified_header(token)
+                
+                # Find the correct key
+                key = self._get_jwk_for_kid(header['kid'])
+                
+                if not key:
+                    return False, "Invalid token - key not found"
+                
+                # Decode token
+                payload = jwt.decode(
+                    token,
+                    key,
+                    algorithms=['RS256'],
+                    audience=f"api://{self.client_id}",
+                    issuer=f"https://sts.windows.net/{self.tenant_id}/"
+                )
+                
+                self._cache_payload(token_hash, payload)
+                
             # Check if token has required roles
             token_roles = payload.get('roles', [])
             
             # Check if any of the required roles are present
-            if not any(role in token_roles for role in required_roles):
-                return False, f"Insufficient permissions. Required: {required_roles}, Found: {token_roles}"
+            if required_roles.isdisjoint(token_roles):
+                return False, f"Insufficient permissions. Required: {sorted(required_roles)}, Found: {token_roles}"
             
             return True, payload
             
@@ -76,6 +176,8 @@ def require_roles(*roles):
     """
     Decorator to require specific roles for API endpoints
     """
+    required_roles = frozenset(roles)
+    
     def decorator(f):
         @wraps(f)
         def decorated_function(*args, **kwargs):
@@ -84,9 +186,9 @@ def require_roles(*roles):
             if not auth_header or not auth_header.startswith('Bearer '):
                 return jsonify({'error': 'Authorization header required'}), 401
             
-            token = auth_header.split(' ')[1]
+            token = auth_header[7:]
             
-            is_valid, result = auth_validator.validate_token_and_roles(token, roles)
+            is_valid, result = auth_validator.validate_token_and_roles(token, required_roles)
             
             if not is_valid:
                 return jsonify({'error': result}), 403
@@ -100,6 +202,17 @@ def require_roles(*roles):
 
 # API Endpoints
 
+# Demo data returned by the list endpoints, built once rather than per request
+_PLANS_STATIC = [
+    {'id': 1, 'name': 'Strategic Plan 2024'},
+    {'id': 2, 'name': 'Operational Plan Q1'}
+]
+
+_ACCOUNTS_STATIC = [
+    {'id': 1, 'name': 'Account A', 'status': 'active'},
+    {'id': 2, 'name': 'Account B', 'status': 'inactive'}
+]
+
 @app.route('/health', methods=['GET'])
 def health():
     """Health check endpoint - no authentication required"""
@@ -111,10 +224,7 @@ def get_plans():
     """Get plans - requires planadmin or accountviewer role"""
     user_info = getattr(request, 'token_payload', {})
     return jsonify({
-        'plans': [
-            {'id': 1, 'name': 'Strategic Plan 2024'},
-            {'id': 2, 'name': 'Operational Plan Q1'}
-        ],
+        'plans': _PLANS_STATIC,
         'user': {
             'sub': user_info.get('sub'),
             'roles': user_info.get('roles', [])
@@ -143,10 +253,7 @@ def get_accounts():
     """Get accounts - requires accountviewer or accountadmin role"""
     user_info = getattr(request, 'token_payload', {})
     return jsonify({
-        'accounts': [
-            {'id': 1, 'name': 'Account A', 'status': 'active'},
-            {'id': 2, 'name': 'Account B', 'status': 'inactive'}
-        ],
+        'accounts': _ACCOUNTS_STATIC,
         'user': {
             'sub': user_info.get('sub'),
             'roles': user_info.get('roles', [])
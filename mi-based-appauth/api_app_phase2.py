@@ -4,64 +4,170 @@ Demonstrates pure managed identity authentication with external authorization
 """
 
 from flask import Flask, request, jsonify
-from azure.identity import DefaultAzureCredential
+from flask.json.provider import DefaultJSONProvider
 import jwt
+import orjson
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import os
+import hashlib
+import threading
+import time
 from functools import wraps
-import json
+from cachetools import TLRUCache, TTLCache
+
+class ORJSONProvider(DefaultJSONProvider):
+    """
+    Flask JSON provider backed by orjson
+    """
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, default=self.default).decode()
+    
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
 
 app = Flask(__name__)
+app.json = ORJSONProvider(app)
 
 # Configuration
 TENANT_ID = os.environ.get('AZURE_TENANT_ID')
 CLIENT_ID = os.environ.get('AZURE_CLIENT_ID')  # Managed Identity client ID
 PLAINID_ENDPOINT = os.environ.get('PLAINID_ENDPOINT', 'https://your-plainid-instance.com/api/v1')
 PLAINID_TOKEN = os.environ.get('PLAINID_TOKEN')
+PLAINID_DECISION_TTL = int(os.environ.get('PLAINID_DECISION_TTL', '30'))
+# Seconds to skip the batch endpoint after it fails, before trying it again
+PLAINID_BATCH_RETRY_INTERVAL = int(os.environ.get('PLAINID_BATCH_RETRY_INTERVAL', '300'))
+
+# Context keys that vary per request but do not change the PlainID decision
+_UNCACHED_CONTEXT_KEYS = frozenset({'request_path', 'request_method'})
+
+# Azure AD signing keys, indexed by kid and stored as parsed RSA public keys
+_JWKS_TTL = 3600
+_JWKS_MIN_REFRESH_INTERVAL = 60
+_JWKS_CACHE = {'fetched_at': 0, 'keys_by_kid': {}}
+_JWKS_LOCK = threading.Lock()
+
+# Validated token payloads are reused until this many seconds before the token expires
+_TOKEN_EXPIRY_SKEW = 30
+
+def _build_http_session():
+    """
+    Build a pooled HTTP session with keep-alive and retries on transient errors
+    """
+    session = requests.Session()
+    retries = Retry(
+        total=2,
+        backoff_factor=0.1,
+        status_forcelist=[502, 503, 504],
+        # Authorization checks are read-only, so POST is safe to retry
+        allowed_methods=frozenset({'GET', 'POST'})
+    )
+    session.mount('https://', HTTPAdapter(pool_connections=32, pool_maxsize=64, max_retries=retries))
+    return session
 
 class ManagedIdentityAuth:
     def __init__(self):
         self.tenant_id = TENANT_ID
         self.client_id = CLIENT_ID
-        self.credential = DefaultAzureCredential()
+        self._http = _build_http_session()
+        self._validated_tokens = TLRUCache(
+            maxsize=10000,
+            ttu=lambda _hash, payload, _now: payload['exp'] - _TOKEN_EXPIRY_SKEW,
+            timer=time.time
+        )
+        self._validated_tokens_lock = threading.RLock()
         
-    def validate_managed_identity_token(self, token):
+    def _get_cached_payload(self, token_hash):
         """
-        Validate managed identity token
-        Returns the token payload if valid, None otherwise
+        Get a previously validated token payload, if it has not expired yet
         """
-        try:
+        with self._validated_tokens_lock:
+            return self._validated_tokens.get(token_hash)
+    
+    def _cache_payload(self, token_hash, payload):
+        """
+        Remember a validated token payload until shortly before the token expires
+        """
+        if 'exp' in payload:
+            with self._validated_tokens_lock:
+                self._validated_tokens[token_hash] = payload
+    
+    def _get_cached_jwk(self, kid):
+        """
+        Look up an already-parsed signing key, ignoring the cache once it is stale
+        """
+        if time.time() - _JWKS_CACHE['fetched_at'] < _JWKS_TTL:
+            return _JWKS_CACHE['keys_by_kid'].get(kid)
+        return None
+    
+    def _get_jwk_for_kid(self, kid):
+        """
+        Get the signing key for a kid, refreshing the cached JWKS when stale
+        """
+        key = self._get_cached_jwk(kid)
+        if key is not None:
+            return key
+        
+        with _JWKS_LOCK:
+            # Another thread may have refreshed the keys while we waited
+            key = self._get_cached_jwk(kid)
+            if key is not None:
+                return key
+            
+            # An unknown kid on fresh keys usually means the keys rotated; force a single
+            # refresh, but not more than once per interval so bogus kids cannot flood Azure AD
+            if time.time() - _JWKS_CACHE['fetched_at'] < _JWKS_MIN_REFRESH_INTERVAL:
+                return None
+            
             # Get Azure AD public keys for token validation
             jwks_url = f"https://login.microsoftonline.com/{self.tenant_id}/discovery/v2.0/keys"
-            jwks_response = requests.get(jwks_url)
+            jwks_response = self._http.get(jwks_url, timeout=5)
+            jwks_response.raise_for_status()
             jwks = jwks_response.json()
             
-            # Decode header to find key
-            header = jwt.get_unverified_header(token)
-            
-            # Find the correct key
-            key = None
-            for jwk in jwks['keys']:
-                if jwk['kid'] == header['kid']:
-                    key = jwt.algorithms.RSAAlgorithm.from_jwk(jwk)
-                    break
-            
-            if not key:
-                return None
-            
-            # Validate token for managed identity
-            # Note: Managed identity tokens use different audience
-            payload = jwt.decode(
-                token,
-                key,
-                algorithms=['RS256'],
-                audience="https://management.azure.com/",  # Standard MI audience
-                issuer=f"https://sts.windows.net/{self.tenant_id}/"
-            )
+            _JWKS_CACHE['keys_by_kid'] = {
+                jwk['kid']: jwt.algorithms.RSAAlgorithm.from_jwk(jwk)
+                for jwk in jwks['keys']
+            }
+            _JWKS_CACHE['fetched_at'] = time.time()
+            return _JWKS_CACHE['keys_by_kid'].get(kid)
+        
+    def validate_managed_identity_token(self, token):
+        """
+        Validate managed identity token
+        Returns the token payload if valid, None otherwise
+        """
+        try:
+            # Reuse the result of an earlier validation of the same token
+            token_hash = hashlib.blake2b(token.encode(), digest_size=16).digest()
+            payload = self._get_cached_payload(token_hash)
             
-            # Verify this is a managed identity token
-            if payload.get('idtyp') != 'MI':
-                return None
+            if payload is None:
+                # Decode header to find key
+                header = jwt.get_unverified_header(token)
+                
+                # Find the correct key
+                key = self._get_jwk_for_kid(header['kid'])
+                
+                if not key:
+                    return None
+                
+                # Validate token for managed identity
+                # Note: Managed identity tokens use different audience
+                payload = jwt.decode(
+                    token,
+                    key,
+                    algorithms=['RS256'],
+                    audience="https://management.azure.com/",  # Standard MI audience
+                    issuer=f"https://sts.windows.net/{self.tenant_id}/"
+                )
+                
+                # Verify this is a managed identity token
+                if payload.get('idtyp') != 'MI':
+                    return None
+                
+                self._cache_payload(token_hash, payload)
                 
             return payload
             
@@ -73,11 +179,32 @@ class PlainIDAuthorizer:
     def __init__(self):
         self.endpoint = PLAINID_ENDPOINT
         self.token = PLAINID_TOKEN
+        self._http = _build_http_session()
+        self._decisions = TTLCache(maxsize=10000, ttl=PLAINID_DECISION_TTL)
+        self._decisions_lock = threading.RLock()
+        # Time before which the batch endpoint is not tried again
+        self._batch_retry_at = 0
         
+    def _decision_key(self, user_id, resource, action, context):
+        """
+        Build a hashable cache key for a permission check
+        """
+        context_items = tuple(sorted(
+            (k, v) for k, v in (context or {}).items() if k not in _UNCACHED_CONTEXT_KEYS
+        ))
+        return (user_id, resource, action, context_items)
+    
     def check_permission(self, user_id, resource, action, context=None):
         """
         Check permission using PlainID
+        Decisions are cached briefly; failures are never cached
         """
+        cache_key = self._decision_key(user_id, resource, action, context)
+        with self._decisions_lock:
+            decision = self._decisions.get(cache_key)
+        if decision is not None:
+            return decision
+        
         try:
             headers = {
                 'Authorization': f'Bearer {self.token}',
@@ -91,16 +218,19 @@ class PlainIDAuthorizer:
                 'context': context or {}
             }
             
-            response = requests.post(
+            response = self._http.post(
                 f"{self.endpoint}/authorize",
                 headers=headers,
-                json=payload,
+                data=orjson.dumps(payload),
                 timeout=5
             )
             
             if response.status_code == 200:
-                result = response.json()
-                return result.get('decision') == 'Permit'
+                result = orjson.loads(response.content)
+                decision = result.get('decision') == 'Permit'
+                with self._decisions_lock:
+                    self._decisions[cache_key] = decision
+                return decision
             else:
                 # Fail secure - deny if PlainID is unavailable
                 print(f"PlainID authorization failed: {response.status_code}")
@@ -111,6 +241,67 @@ class PlainIDAuthorizer:
             # Fail secure - deny if there's an error
             return False
     
+    def check_permissions_batch(self, user_id, checks):
+        """
+        Check several permissions in a single PlainID round trip
+        checks is a list of (resource, action, context) tuples; returns a decision per check
+        """
+        cache_keys = [self._decision_key(user_id, *check) for check in checks]
+        with self._decisions_lock:
+            decisions = [self._decisions.get(cache_key) for cache_key in cache_keys]
+        
+        pending = [i for i, decision in enumerate(decisions) if decision is None]
+        if len(pending) > 1 and time.time() >= self._batch_retry_at:
+            try:
+                headers = {
+                    'Authorization': f'Bearer {self.token}',
+                    'Content-Type': 'application/json'
+                }
+                
+                payload = {
+                    'user': user_id,
+                    'requests': [
+                        {
+                            'resource': checks[i][0],
+                            'action': checks[i][1],
+                            'context': checks[i][2] or {}
+                        }
+                        for i in pending
+                    ]
+                }
+                
+                response = self._http.post(
+                    f"{self.endpoint}/authorize/batch",
+                    headers=headers,
+                    data=orjson.dumps(payload),
+                    timeout=5
+                )
+                
+                if response.status_code != 200:
+                    raise ValueError(f"status {response.status_code}")
+                
+                results = orjson.loads(response.content).get('decisions')
+                if not isinstance(results, list) or len(results) != len(pending):
+                    raise ValueError("malformed batch response")
+                batch_decisions = [result.get('decision') == 'Permit' for result in results]
+                
+                with self._decisions_lock:
+                    for i, decision in zip(pending, batch_decisions):
+                        decisions[i] = decision
+                        self._decisions[cache_keys[i]] = decision
+                return decisions
+                    
+            except Exception as e:
+                # Any failure means the batch endpoint is missing or unhealthy; skip it for a
+                # while so requests do not pay for a failed round trip before falling back
+                self._batch_retry_at = time.time() + PLAINID_BATCH_RETRY_INTERVAL
+                print(f"PlainID batch authorization unavailable, using single checks: {e}")
+        
+        # Fall back to one call per check
+        for i in pending:
+            decisions[i] = self.check_permission(user_id, *checks[i])
+        return decisions
+    
     def get_user_permissions(self, user_id):
         """
         Get all permissions for a user from PlainID
@@ -121,14 +312,14 @@ class PlainIDAuthorizer:
                 'Content-Type': 'application/json'
             }
             
-            response = requests.get(
+            response = self._http.get(
                 f"{self.endpoint}/permissions/{user_id}",
                 headers=headers,
                 timeout=5
             )
             
             if response.status_code == 200:
-                return response.json()
+                return orjson.loads(response.content)
             else:
                 return {}
                 
@@ -140,9 +331,11 @@ class PlainIDAuthorizer:
 auth_validator = ManagedIdentityAuth()
 plainid_authorizer = PlainIDAuthorizer()
 
-def require_permission(resource, action):
+def require_permission(resource, action, scoped_resource=None):
     """
     Decorator to require specific permission for API endpoints using PlainID
+    scoped_resource is an optional per-object resource template (e.g. 'accounts/{account_id}'),
+    filled from the route arguments and checked in the same PlainID round trip
     """
     def decorator(f):
         @wraps(f)
@@ -152,7 +345,7 @@ def require_permission(resource, action):
             if not auth_header or not auth_header.startswith('Bearer '):
                 return jsonify({'error': 'Authorization header required'}), 401
             
-            token = auth_header.split(' ')[1]
+            token = auth_header[7:]
             
             # Validate managed identity token
             payload = auth_validator.validate_managed_identity_token(token)
@@ -174,15 +367,23 @@ def require_permission(resource, action):
                 'request_method': request.method
             }
             
-            has_permission = plainid_authorizer.check_permission(
-                user_id, resource, action, context
-            )
+            checks = [(resource, action, context)]
+            if scoped_resource:
+                # Additional fine-grained check for the specific object
+                checks.append((scoped_resource.format(**kwargs), action, dict(kwargs)))
+            
+            decisions = plainid_authorizer.check_permissions_batch(user_id, checks)
             
-            if not has_permission:
+            if not decisions[0]:
                 return jsonify({
                     'error': f'Access denied. Required permission: {action} on {resource}'
                 }), 403
             
+            if scoped_resource and not decisions[1]:
+                return jsonify({
+                    'error': f'Access denied for {checks[1][0]}'
+                }), 403
+            
             # Add user info to request context
             request.token_payload = payload
             request.user_id = user_id
@@ -193,6 +394,17 @@ def require_permission(resource, action):
 
 # API Endpoints
 
+# Demo data returned by the list endpoints, built once rather than per request
+_PLANS_STATIC = [
+    {'id': 1, 'name': 'Strategic Plan 2024', 'status': 'active'},
+    {'id': 2, 'name': 'Operational Plan Q1', 'status': 'draft'}
+]
+
+_ACCOUNTS_STATIC = [
+    {'id': 1, 'name': 'Account A', 'status': 'active'},
+    {'id': 2, 'name': 'Account B', 'status': 'inactive'}
+]
+
 @app.route('/health', methods=['GET'])
 def health():
     """Health check endpoint - no authentication required"""
@@ -209,10 +421,7 @@ def get_plans():
     user_permissions = plainid_authorizer.get_user_permissions(user_id)
     
     return jsonify({
-        'plans': [
-            {'id': 1, 'name': 'Strategic Plan 2024', 'status': 'active'},
-            {'id': 2, 'name': 'Operational Plan Q1', 'status': 'draft'}
-        ],
+        'plans': _PLANS_STATIC,
         'user': {
             'managed_identity_id': user_info.get('oid'),
             'client_id': user_info.get('appid'),
@@ -246,10 +455,7 @@ def get_accounts():
     user_id = getattr(request, 'user_id', '')
     
     return jsonify({
-        'accounts': [
-            {'id': 1, 'name': 'Account A', 'status': 'active'},
-            {'id': 2, 'name': 'Account B', 'status': 'inactive'}
-        ],
+        'accounts': _ACCOUNTS_STATIC,
         'user': {
             'managed_identity_id': user_id,
             'client_id': user_info.get('appid')
@@ -257,24 +463,13 @@ def get_accounts():
     })
 
 @app.route('/api/accounts/<int:account_id>/settings', methods=['PUT'])
-@require_permission('accounts', 'update')
+@require_permission('accounts', 'update', scoped_resource='accounts/{account_id}')
 def update_account_settings(account_id):
-    """Update account settings - permission checked via PlainID"""
+    """Update account settings - permission checked via PlainID, including for the specific account"""
     settings_data = request.get_json()
     user_info = getattr(request, 'token_payload', {})
     user_id = getattr(request, 'user_id', '')
     
-    # Additional fine-grained check for specific account
-    context = {'account_id': account_id}
-    can_update_account = plainid_authorizer.check_permission(
-        user_id, f'accounts/{account_id}', 'update', context
-    )
-    
-    if not can_update_account:
-        return jsonify({
-            'error': f'Access denied for account {account_id}'
-        }), 403
-    
     return jsonify({
         'message': f'Account {account_id} settings updated',
         'settings': settings_data,
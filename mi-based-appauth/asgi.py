@@ -0,0 +1,22 @@
+"""
+ASGI Entry Point for the API Applications
+Serves the Flask app from a thread pool so concurrent requests can overlap their JWKS/PlainID I/O
+
+Run with:
+    uvicorn asgi:asgi_app --workers 4 --host 0.0.0.0 --port 8000
+"""
+
+import importlib
+import os
+from a2wsgi import WSGIMiddleware
+
+# Which API to serve: api_app_phase1 or api_app_phase2
+API_APP_MODULE = os.environ.get('API_APP_MODULE', 'api_app_phase2')
+# Threads per Uvicorn worker; each one can be blocked on a JWKS/PlainID call.
+# Keep this at or below the requests connection pool size (pool_maxsize=64)
+ASGI_THREADS = int(os.environ.get('ASGI_THREADS', '16'))
+
+app = importlib.import_module(API_APP_MODULE).app
+# Unlike asgiref's WsgiToAsgi, which runs every request on one shared thread,
+# a2wsgi hands each request to a thread pool
+asgi_app = WSGIMiddleware(app, workers=ASGI_THREADS)
@@ -0,0 +1,18 @@
+"""
+Gunicorn Configuration for the API Applications
+Runs the Flask app with threaded workers so blocking JWKS/PlainID calls overlap
+
+Run with:
+    gunicorn -c gunicorn.conf.py api_app_phase2:app
+"""
+
+import multiprocessing
+import os
+
+bind = os.environ.get('GUNICORN_BIND', '0.0.0.0:8000')
+worker_class = 'gthread'
+workers = int(os.environ.get('GUNICORN_WORKERS', multiprocessing.cpu_count()))
+# Each worker process has its own requests connection pool (pool_maxsize=64),
+# so keep threads per worker at or below that to avoid waiting on connections
+threads = int(os.environ.get('GUNICORN_THREADS', '8'))
+keepalive = 30